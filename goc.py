@@ -4,149 +4,200 @@
 # This program is free software under AGPLv3 license
 # License terms are in the LICENSE file, or at <http://www.gnu.org/licenses/>.
 
-import sqlite3, argparse, math, os, sys
+import sqlite3, argparse, collections, itertools, multiprocessing, os, sys
+import numpy as np
 
-parser = argparse.ArgumentParser(
-    description="""This script computes GOC for pairwise genomes in the database"""
-)
-parser.add_argument("database", type=str, help="path to the sqlite3 database")
-args = parser.parse_args()
-
-db_file = args.database
-
-# Load database
-
-if not os.path.isfile(db_file):
-    sys.exit("exit")
+window_proportion = 3
 
-conn = sqlite3.connect(db_file)
 
-cur = conn.cursor()
+def compute_goc(ort_ref, ort_tar, number_cds, window_length):
+    """Compute the GOC score of every window along the reference CDS.
+
+    ort_ref and ort_tar give the position of each orthologous CDS in the
+    reference and in the target lists of CDS (-1 if the target gene is not a
+    CDS). Window k covers the reference CDS k to k + window_length - 1.
+    """
+    number_windows = max(number_cds - window_length + 1, 0) if number_cds else 0
+    if len(ort_ref) == 0:
+        # No ortholog, no synteny in any window
+        return np.zeros(number_windows)
+
+    tar_idx = np.full(number_cds, -1, dtype=np.int64)
+    tar_idx[ort_ref] = ort_tar
+
+    # Synteny events between each CDS of the reference and the next one:
+    # the pair is syntenic if both orthologs are neighbours in the target
+    # (in either direction), and breaks the current syntenic region unless
+    # the ortholog is the first CDS of the target
+    index_tar = tar_idx[:-1]
+    index_next = tar_idx[1:]
+    found = (index_tar >= 0) & (index_next >= 0)
+    list_forward = found & (index_next - index_tar == 1)
+    list_synt = found & (np.abs(index_next - index_tar) == 1)
+    list_break = ~list_synt & (index_tar != 0)
+
+    # Each syntenic region also counts its first CDS, so every syntenic
+    # pair contributes 1, plus 1 if it starts a new region, i.e. if the
+    # last pair that extended or broke a region before it was a break
+    pairs = np.arange(number_cds - 1)
+    list_event = list_synt | list_break
+    last_event = np.maximum.accumulate(np.where(list_event, pairs, -1))
+    prev_event = np.concatenate(([-1], last_event))[:-1]
+    new_synt_region = (prev_event < 0) | list_break[np.maximum(prev_event, 0)]
+    list_count = list_synt.astype(np.int64) + (list_synt & new_synt_region)
+
+    # Position of the next pair that either extends or breaks a region
+    next_event = np.where(list_event, pairs, number_cds)
+    list_next_event = np.minimum.accumulate(next_event[::-1])[::-1]
+
+    # Sum the pairs of each window. The first pair of a window is only
+    # counted if it is syntenic in the forward direction, and always
+    # starts a region, which changes the count of the first event after it
+    last_pair = window_length - 2
+    starts = np.arange(number_windows)
+    cumul_count = np.concatenate(([0], np.cumsum(list_count)))
+    number_cds_in_synt_region = (
+        cumul_count[starts + last_pair + 1] - cumul_count[starts + 1]
+    )
+    first_forward = list_forward[starts]
+    number_cds_in_synt_region += 2 * first_forward
+    first_event = list_next_event[starts + 1]
+    in_window = first_event <= starts + last_pair
+    first_event = np.minimum(first_event, number_cds - 2)
+    first_corrected = in_window & list_synt[first_event]
+    number_cds_in_synt_region += first_corrected * (
+        (~first_forward) - (list_count[first_event] - 1)
+    )
+    return number_cds_in_synt_region / window_length
+
+
+def compute_pair(pair):
+    """Compute the GOC rows of a pair of species, in a worker process."""
+    ref, tar, cds_gene_ref, ort_ref, ort_tar = pair
+    limit = len(cds_gene_ref)
+    window_length = (limit + 99) // 100 * window_proportion
+    loc_start_window = (window_length + 1) // 2
+
+    list_goc_cds = compute_goc(ort_ref, ort_tar, limit, window_length).tolist()
+    list_goc_loc = cds_gene_ref[
+        loc_start_window : loc_start_window + len(list_goc_cds)
+    ].tolist()
+    return [
+        (ref, tar, goc_loc, goc_cds)
+        for goc_loc, goc_cds in zip(list_goc_loc, list_goc_cds)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="""This script computes GOC for pairwise genomes in the database"""
+    )
+    parser.add_argument("database", type=str, help="path to the sqlite3 database")
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=0,
+        help="number of processes (default: 0, one per CPU)",
+    )
+    args = parser.parse_args()
+
+    db_file = args.database
+
+    # Load database
+
+    if not os.path.isfile(db_file):
+        sys.exit("exit")
+
+    conn = sqlite3.connect(db_file)
+
+    cur = conn.cursor()
+
+    # All the rows are inserted in a single transaction: no need to wait for every
+    # write to reach the disk
+    cur.execute("PRAGMA journal_mode = MEMORY")
+    cur.execute("PRAGMA synchronous = OFF")
+
+    # Index the columns used to fetch the genes and orthologs of each species
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_genes_sp_feat ON genes(sp, feat)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_orthos_pid1 ON orthos(pid1)")
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_genome_parts_gpart ON genome_parts(gpart)"
+    )
+    cur.execute("ANALYZE")
+
+    cur.execute("""CREATE TABLE goc(sp1 TEXT, sp2 TEXT, pos INTEGER, score REAL)""")
+
+    # Get all species in the database
+
+    cur.execute("SELECT DISTINCT sp FROM genes;")
+    list_species = [x[0] for x in cur]
+
+    # Get the ordered CDS of every species in one pass, with the position of each
+    # CDS among all the genes of its species
+
+    empty = np.zeros(0, dtype=np.int64)
+    cds_gene_by_sp = {sp: empty for sp in list_species}
+    cds_index = {}
+    cur.execute(
+        "SELECT g.sp, g.feat, g.pid FROM genes g JOIN genome_parts gp ON g.gpart = gp.gpart ORDER BY g.sp, gp.min, loc_start ASC;"
+    )
+    for sp, rows in itertools.groupby(cur, key=lambda x: x[0]):
+        list_cds_gene = []
+        for i, (_, feat, pid) in enumerate(rows):
+            if feat == "CDS":
+                cds_index[pid] = len(list_cds_gene)
+                list_cds_gene.append(i)
+        cds_gene_by_sp[sp] = np.array(list_cds_gene, dtype=np.int64)
+
+    # Get the orthologs of the CDS of every species, by pair of species, as the
+    # positions of both CDS in their species
+
+    cur.execute(
+        "SELECT g1.sp, g2.sp, g1.pid gene_id1, g2.pid gene_id2 FROM orthos o JOIN genes g1 ON o.pid1 = g1.pid JOIN genes g2 ON o.pid2 = g2.pid WHERE g1.feat = 'CDS';"
+    )
+    ort_by_pair = collections.defaultdict(dict)
+    for sp1, sp2, pid1, pid2 in cur:
+        index_ref = cds_index.get(pid1, -1)
+        if index_ref != -1:
+            ort_by_pair[(sp1, sp2)][index_ref] = cds_index.get(pid2, -1)
+    for pair, ort in ort_by_pair.items():
+        ort_by_pair[pair] = (
+            np.fromiter(ort.keys(), dtype=np.int64, count=len(ort)),
+            np.fromiter(ort.values(), dtype=np.int64, count=len(ort)),
+        )
 
-cur.execute("""CREATE TABLE goc(sp1 TEXT, sp2 TEXT, pos INTEGER, score REAL)""")
+    # GOC is not symmetric: the windows follow the CDS order of the reference and
+    # their size depends on its number of CDS, so every ordered pair is computed
+    number_pairs = len(list_species) ** 2 - len(list_species)
+    pairs = (
+        (ref, tar, cds_gene_by_sp[ref]) + ort_by_pair.get((ref, tar), (empty, empty))
+        for ref in list_species
+        for tar in list_species
+        if ref != tar
+    )
+
+    # The pairs are independent: compute them in parallel, and insert the rows
+    # from this process in the order of the pairs
+    c = 0
+    with multiprocessing.Pool(args.jobs or None) as pool:
+        for rows in pool.imap(compute_pair, pairs, chunksize=8):
+            c += 1
+            print(
+                ("\r\t" + str(c) + "/" + str(number_pairs) + " GOC computation"),
+                end="",
+            )
 
-# Get all species in the database
+            # Insert the rows of data
+            cur.executemany("INSERT INTO goc VALUES (?, ?, ?, ?)", rows)
+    print("\n")
 
-cur.execute("SELECT DISTINCT sp FROM genes;")
-list_species = [x[0] for x in cur.fetchall()]
+    # Save the changes
+    conn.commit()
 
-c = 0
-window_proportion = 3
-for ref in list_species:
-    for tar in list_species:
-        if ref == tar:
-            continue
-        c += 1
-        print(
-            (
-                "\r\t"
-                + str(c)
-                + "/"
-                + str((len(list_species) ** 2) - len(list_species))
-                + " GOC computation"
-            ),
-            end="",
-        )
+    cur.close()
+    conn.close()
 
-        # Get all CDS for the reference
-        cur.execute(
-            "SELECT g.pid FROM genes g JOIN genome_parts gp ON g.gpart = gp.gpart WHERE feat = 'CDS' and g.sp = ? ORDER BY gp.min, loc_start ASC;",
-            (ref,),
-        )
-        list_cds_ref = [x[0] for x in cur.fetchall()]
-
-        # Get all genes for the reference
-        cur.execute(
-            "SELECT g.pid FROM genes g JOIN genome_parts gp ON g.gpart = gp.gpart WHERE g.sp = ? ORDER BY gp.min, loc_start ASC;",
-            (ref,),
-        )
-        list_gene_ref = [x[0] for x in cur.fetchall()]
-
-        # Get all CDS for the target
-        cur.execute(
-            "SELECT g.pid FROM genes g JOIN genome_parts gp ON g.gpart = gp.gpart WHERE feat = 'CDS' and g.sp = ? ORDER BY gp.min, loc_start ASC;",
-            (tar,),
-        )
-        list_cds_tar = [x[0] for x in cur.fetchall()]
-
-        # SQL request preparation
-        sql_prep_cds_list = "'"
-        sql_prep_cds_list = sql_prep_cds_list + ("', '").join(list_cds_ref) + "'"
-        sql_handler = (
-            "SELECT g1.pid gene_id1, g2.pid gene_id2 FROM orthos o JOIN genes g1 ON o.pid1 = g1.pid JOIN genes g2 ON o.pid2 = g2.pid WHERE o.pid1 IN ("
-            + sql_prep_cds_list
-            + ") AND g2.sp = '"
-            + tar
-            + "';"
-        )
-        cur.execute(sql_handler)
-
-        # Data preparation
-        ort = {}
-        raw_sql_ort = cur.fetchall()
-        for i in raw_sql_ort:
-            ort[i[0]] = i[-1]
-
-        # GOC computation
-        goc_cds = []
-        goc_loc = []
-        limit = len(list_cds_ref)
-        window_length = math.ceil(limit / 100.0) * window_proportion
-        loc_start_window = math.ceil(window_length / 2.0)
-        start_window = 0
-        list_tar_ort = [ort[x] if x in ort else "NA" for x in list_cds_ref]
-        while start_window < (limit - window_length):
-            window = list_tar_ort[start_window : (start_window + window_length)]
-            limit_computation = len(window) - 1
-            index_tar_max = len(list_cds_tar) - 1
-            new_synt_region = True
-            number_cds_in_synt_region = 0
-            for index_ref, cds_tar in enumerate(window):
-                if cds_tar != "NA":
-                    if index_ref < limit_computation:
-                        index_tar = list_cds_tar.index(window[index_ref])
-                        if (
-                            index_tar != index_tar_max
-                            and list_cds_tar[index_tar + 1] == window[index_ref + 1]
-                        ):
-                            number_cds_in_synt_region += 1
-                            if new_synt_region:
-                                number_cds_in_synt_region += 1
-                                new_synt_region = False
-                            continue
-                        elif index_ref > 0 and index_tar != 0:
-                            if list_cds_tar[index_tar - 1] == window[index_ref + 1]:
-                                number_cds_in_synt_region += 1
-                                if new_synt_region:
-                                    number_cds_in_synt_region += 1
-                                    new_synt_region = False
-                            else:
-                                new_synt_region = True
-                                continue
-                else:
-                    new_synt_region = True
-            goc_cds = number_cds_in_synt_region / len(window)
-            # goc_loc = loc_start_window
-            goc_loc = list_gene_ref.index(list_cds_ref[loc_start_window])
-            start_window += 1
-            loc_start_window += 1
-
-            # Insert a row of data
-            handler = (
-                "INSERT INTO goc VALUES ('"
-                + ref
-                + "','"
-                + tar
-                + "','"
-                + str(goc_loc)
-                + "','"
-                + str(goc_cds)
-                + "')"
-            )
-            cur.execute(handler)
-        # Save the changes
-        conn.commit()
-print("\n")
 
-cur.close()
-conn.close()
+if __name__ == "__main__":
+    main()